@@ -5,7 +5,8 @@ usage:         see --help
 """
 import re
 from argparse import ArgumentParser, RawTextHelpFormatter
-from sys import stdout
+from functools import lru_cache, partial
+from sys import stdin, stdout
 from shutil import get_terminal_size
 
 __version__ = "1.1"
@@ -46,6 +47,9 @@ examples:
     use a different LaTeX package (e.g. ytableau):
         python vis_partition.py -l -e -c ytableau"""
 
+_SIGN_RE = re.compile(r"([+-])(?![^\[\]]*\])")
+_TERM_RE = re.compile(r"S(\d+)\s*(\[)?([^\[\]S]*)(?(2)\])\s*")
+
 
 def chunks(iterable, n=1):
     """Yield chunks of size n from iterable."""
@@ -60,49 +64,76 @@ def removeprefix(s, prefix):
     return s
 
 
-def removesuffix(s, suffix):
-    if s.endswith(suffix):
-        return s[:-len(suffix)]
-    return s
+def _split_blocks(data):
+    """Split data into blocks of non-blank lines separated by one or more blank lines.
+
+    Example:
+        "a\\nb\\n\\n\\nc\\n"
+        --> ["a\\nb", "c"]
+    """
+    blocks = []
+    block = []
+    for line in data.split("\n"):
+        if line.strip():
+            block.append(line)
+        elif block:
+            blocks.append("\n".join(block))
+            block = []
+    if block:
+        blocks.append("\n".join(block))
+    return blocks
+
+
+@lru_cache(maxsize=4096)
+def _parse_partition(body):
+    """Parse a comma separated partition body such as "3, 2, 2" into a tuple of ints.
+    Raises ValueError if any part is negative.
+    Results are cached, since the same partitions tend to repeat across an input."""
+    partition = tuple(map(int, body.split(",")))
+    if min(partition) < 0:
+        raise ValueError("negative part in " + repr(body))
+    return partition
 
 
 def substring_to_group(substring):
     """Parses a substring of the form:
         aS1[partition1...] S2[partition2...] ...
-    Into a list of lists:
-        ["a", ["S1", partition1...], ["S2", partition2...], ...].
+    Into a list of the lead followed by the partitions as tuples, sorted by the index on S:
+        ["a", (partition1...), (partition2...), ...].
 
     Example:
         2S1[3] S2[1, 1] S4[2, 2] S3[1]
-        --> ["a", ["S1", 3], ["S2", 1,1], ["S4", 2,2], ["S3", 1]]
+        --> ["2", (3,), (1, 1), (1,), (2, 2)]
     """
-    lead, substring, _ = re.split(r"(S.*)", substring, maxsplit=1)
-    s_part_strings = re.split(r"(S\d+)", substring)[1:]
-    s_strings = s_part_strings[::2]
-    part_strings = s_part_strings[1::2]
-    s_ints = [int(removeprefix(x, "S")) for x in s_strings]
-    parts = [
-        removesuffix(removeprefix(x.strip(), "["), "]")
-    for x in part_strings]
-    terms = list(zip(s_ints, parts))
-    terms.sort(key = lambda x: x[0])
+    lead, _, _ = substring.partition("S")
+    terms = []
+    pos = len(lead)
+    while pos < len(substring):
+        match = _TERM_RE.match(substring, pos)
+        if match is None:
+            raise ValueError("could not parse " + repr(substring[pos:]))
+        terms.append((match.group(1), match.group(3)))
+        pos = match.end()
+    if not terms:
+        raise ValueError("no S terms in " + repr(substring))
+    terms.sort(key = lambda x: int(x[0]))
     output = [lead]
     for _, part in terms:
-        output.append([int(x.strip()) for x in part.split(",")])
+        output.append(_parse_partition(part))
     return output
 
 
 def string_to_encoding(data):
     """Parses a string of the form:
         aS1[1a] S2[1b] ... + bS1[2a] S2[2b] ... - cS1[3a] S2[3b] ... + ...
-    Into a list of list of lists:
-        [["+", "a", ["S1", 1a], ["S2", 1b], ...], ["+", "b", ["S1", 2a], ["S2", 2b], ...], ["-", "c", ["S1", 3a], ["S2", 3b], ...], ...]
+    Into a list of groups, each a list of the sign, the lead and the partitions as tuples:
+        [["+", "a", (1a...), (1b...), ...], ["+", "b", (2a...), (2b...), ...], ["-", "c", (3a...), (3b...), ...], ...]
 
     Example:
         S1[3] S2[1, 1] S3[2, 2] S4[1] - 3S1[3] S2[0] S3[1, 1] S4[1]
-        --> [["+", ["S1", 3], ["S2", 1, 1], ["S3", 2,2], ["S4", 1]], ["-", "3", ["S1", 3], ["S2", 0], ["S3", 1, 1], ["S4", 1]]
+        --> [["+", "", (3,), (1, 1), (2, 2), (1,)], ["-", "3", (3,), (0,), (1, 1), (1,)]]
     """
-    substrings = re.split(r"(\+|-)", data)
+    substrings = _SIGN_RE.split(data)
     substrings = [x.strip() for x in substrings]
     if len(substrings[0]) == 0:
         substrings = substrings[1:]
@@ -110,13 +141,14 @@ def string_to_encoding(data):
         substrings.insert(0, "+")
     assert len(substrings) % 2 == 0
     output = []
-    for sign, substring in chunks(substrings, 2):
+    terms = iter(substrings)
+    for sign, substring in zip(terms, terms):
         encoding = substring_to_group(substring)
         output.append([sign] + encoding)
     return output
 
 
-def join_lines(line_groups, max_lines, max_width=None):
+def join_lines(line_groups, max_width=None):
     """Join groups of lines in parallel rows such that no row exceeds max_width.
     
     Example:
@@ -129,18 +161,45 @@ def join_lines(line_groups, max_lines, max_width=None):
     idx = 0
     chunk_strings = []
     adjusted_width = int(max_width * 0.9)
-    while idx < len(line_groups):
+    num_groups = len(line_groups)
+    widths = [len(lines[0]) for lines in line_groups]
+    while idx < num_groups:
         chunk = [line_groups[idx]]
+        chunk_width = widths[idx]
         idx += 1
-        while idx < len(line_groups) and sum(len(c[0]) for c in chunk) + len(line_groups[idx][0]) < adjusted_width:
+        while idx < num_groups and chunk_width + widths[idx] < adjusted_width:
             chunk.append(line_groups[idx])
+            chunk_width += widths[idx]
             idx += 1
         chunk_strings.append("\n".join([
-            " ".join([lines[i] for lines in chunk])
-        for i in range(max_lines)]))
+            " ".join(row)
+        for row in zip(*chunk)]))
     return "\n\n".join(chunk_strings)
 
-        
+
+@lru_cache(maxsize=128)
+def _row_layout(max_parts, lead_len, sep_len, boundary):
+    """Compute the layout shared by the rows below the first in group_to_lines.
+    Returns the column offset of each partition and a blank row with the boundary characters in place.
+    Groups of the same shape reuse the cached layout.
+
+    Example:
+        max_parts = (3, 2, 1), lead_len = 1, sep_len = 2, boundary = ("(", ")")
+        -->
+        ((4, 9, 13), b"   (          )")
+    """
+    offsets = []
+    col = 3 + lead_len
+    for max_part in max_parts:
+        offsets.append(col)
+        col += max_part + sep_len
+    row_width = col - sep_len + 1
+    blank_row = bytearray(b" " * row_width)
+    blank_row[offsets[0] - 1] = ord(boundary[0])
+    blank_row[row_width - 1] = ord(boundary[1])
+    return tuple(offsets), bytes(blank_row)
+
+
 def group_to_lines(group, idx, sep, boundary):
     """Convert a group of partitions into a list of lines to be vertically aligned.
     The separator sep is used between partitions. If the index idx is 0, a leading + is omitted.
@@ -153,23 +212,31 @@ def group_to_lines(group, idx, sep, boundary):
          "    xx   x     ",
          "    xx         "]
     """
+    parts = group[2:]
+    max_parts = [max(max(partition), 1) for partition in parts]
+    lens = [len(partition) for partition in parts]
+    nrows = max(lens)
+    xrow = "x" * max(max_parts)
     first_line_parts = []
-    for partition in group[2:]:
-        max_part = max(max(partition), 1)
+    for partition, max_part in zip(parts, max_parts):
         if len(partition) == 1 and partition[0] == 0:
             first_line_parts.append("1")
         else:
-            first_line_parts.append("x"*partition[0] + " "*(max_part - partition[0]))
-    lines = [group[0] + " " + group[1] + "(" + sep.join(first_line_parts) + ")"]
-    for i in range(1,max(len(partition) for partition in group[2:])):
-        line = "  " + " "*len(group[1]) + boundary[0]
-        for j, partition in enumerate(group[2:]):
-            max_part = max(max(partition), 1)
-            spacing = " "*len(sep) if j > 0 else ""
-            part = partition[i] if i < len(partition) else 0
-            line += spacing + "x"*part + " "*(max_part - part)
-        line += boundary[1]
-        lines.append(line)
+            first_line_parts.append(xrow[:partition[0]].ljust(max_part))
+    lines = ["".join([group[0], " ", group[1], "(", sep.join(first_line_parts), ")"])]
+    # The remaining rows only contain x's, spaces and the boundary characters,
+    # so draw them all onto a single ascii canvas and slice it into lines
+    offsets, blank_row = _row_layout(tuple(max_parts), len(group[1]), len(sep), boundary)
+    row_width = len(blank_row)
+    canvas = bytearray(blank_row * (nrows - 1))
+    xbytes = memoryview(xrow.encode("ascii"))
+    for partition, offset in zip(parts, offsets):
+        for i in range(1, len(partition)):
+            part = partition[i]
+            start = (i - 1)*row_width + offset
+            canvas[start:start + part] = xbytes[:part]
+    text = canvas.decode("ascii")
+    lines += [text[k:k + row_width] for k in range(0, len(text), row_width)]
     if idx == 0 and group[0] == "+":
         lines = [line[2:] for line in lines]
     assert all(len(line) == len(lines[0]) for line in lines)
@@ -188,19 +255,21 @@ def encoding_to_text(encoding, sep, max_width, tall):
         lines += [" "*len(lines[0])]*(max_lines - len(lines))
     if max_width is None:
         final_lines = [
-            " ".join([lines[i] for lines in line_groups])
-        for i in range(max_lines)]
+            " ".join(row)
+        for row in zip(*line_groups)]
         return "\n".join(final_lines)
     else:
-        return join_lines(line_groups, max_lines, max_width)
+        return join_lines(line_groups, max_width)
 
 
+@lru_cache(maxsize=4096)
 def partition_to_latex(partition, command, environment):
     """Generate the LaTeX code for a single partition. Use the specified latex command.
     If latex_environment is set, it will generate code for an environment rather than a command.
+    Results are cached, so the partition must be given as a tuple.
     
     Example:
-        [3, 2, 2, 1]
+        (3, 2, 2, 1)
         --> \\command{~ & ~ & ~ \\\\ ~ & ~ \\\\ ~ & ~ \\\\ ~}
      or --> \\begin{command} ~ & ~ & ~ \\\\ ~ & ~ \\\\ ~ & ~ \\\\ ~ \\end{command}
     """
@@ -217,69 +286,81 @@ def partition_to_latex(partition, command, environment):
 def encoding_to_latex(encoding, sep, command, environment):
     """Convert an encoding to LaTeX code, with the separator sep between partitions.
     See partition_to_latex for the meaning of the other arguments."""
-    output = ""
+    group_strings = []
     for group in encoding:
         partition_strings = [
             partition_to_latex(partition, command, environment)
         for partition in group[2:]]
-        output += "\n" + group[0] + " " + group[1] + "\\left(" + sep.join(partition_strings) + "\\right) "
-    output = output[1:]
+        group_strings.append(group[0] + " " + group[1] + "\\left(" + sep.join(partition_strings) + "\\right) ")
+    output = "\n".join(group_strings)
     if output[0] == "+":
         output = output[1:]
     return output.strip()
     
 
-def display_partitions(data, sep=None, as_latex=False, latex_command=None, latex_environment=False, output_stream=None, wrapping=False, tall=False, verbose=False):
-    
-    if output_stream is None:
-        output_stream = stdout
+def format_partitions(data, sep=None, as_latex=False, latex_command=None, latex_environment=False, wrapping=False, width=None, tall=False, verbose=False, error_stream=None):
+    """Return the visualization of data as a string, or None if it can't be produced.
+    Text output is wrapped to width if it is given, otherwise to the terminal width if wrapping is set.
+    The zero-length group message is printed to error_stream (default stdout), while
+    decode and display failures are always printed to stdout."""
+
+    if error_stream is None:
+        error_stream = stdout
     try:
         encoding = string_to_encoding(data)
     except Exception:
         print("Failed to Decode Input String")
         if verbose:
             raise
-        return
+        return None
 
     # Check for any invalid groups
-    if any(len(group) == 1 for group in encoding):
-        empty_groups = [i for i, group in enumerate(encoding) if len(group) == 1]
+    empty_groups = [i for i, group in enumerate(encoding) if len(group) == 1]
+    if empty_groups:
         group_s, index_s = "groups","indices"
         if len(empty_groups) == 1:
             empty_groups = empty_groups[0]
             group_s, index_s = "group", "index"
-        print("Invalid Input: zero length", group_s, "at", index_s, empty_groups, file=output_stream)
-        print("(ex: \"S1[3] S2[1, 1] S3[2, 2] S4[1] - S1[3] S2[0] S3[1, 1] S4[1]\")", file=output_stream)
-        return
+        print("Invalid Input: zero length", group_s, "at", index_s, empty_groups, file=error_stream)
+        print("(ex: \"S1[3] S2[1, 1] S3[2, 2] S4[1] - S1[3] S2[0] S3[1, 1] S4[1]\")", file=error_stream)
+        return None
     
     try:
 
-        if output_stream == stdout:
-            print("", file=output_stream)
-
         if as_latex:
             if latex_command is None:
                 latex_command = "tableau"
             if sep is None:
                 sep = ",\, "
-            output = encoding_to_latex(encoding, sep, latex_command, latex_environment)
+            return encoding_to_latex(encoding, sep, latex_command, latex_environment)
 
         else:
             if sep is None:
                 sep = ", "
-            if wrapping:
+            if width is None and wrapping:
                 width, _ = get_terminal_size((60, 20))
-            else:
-                width = None
-            output = encoding_to_text(encoding, sep, width, tall)
-
-        print(output, file=output_stream)
+            return encoding_to_text(encoding, sep, width, tall)
 
     except Exception:
         print("Failed to Display Encoding")
         if verbose:
             raise
+        return None
+
+
+def display_partitions(data, sep=None, as_latex=False, latex_command=None, latex_environment=False, output_stream=None, wrapping=False, width=None, tall=False, verbose=False):
+    """Print the visualization of data to output_stream (default stdout).
+    See format_partitions for the meaning of the other arguments."""
+
+    if output_stream is None:
+        output_stream = stdout
+    output = format_partitions(data, sep=sep, as_latex=as_latex, latex_command=latex_command, latex_environment=latex_environment,
+                               wrapping=wrapping, width=width, tall=tall, verbose=verbose, error_stream=output_stream)
+    if output is None:
         return
+    if output_stream == stdout:
+        print("", file=output_stream)
+    print(output, file=output_stream)
     
 
 def main():
@@ -316,28 +397,51 @@ def main():
     if args.file:
         with open(args.file, "r") as f:
             data = f.read()
-        if args.out and not args.append:
-            with open(args.out, "w") as f:
-                f.write("")
         if args.out:
-            with open(args.out, "a") as f:
-                for i, d in enumerate(re.split(r"[\n]{2,}", data)):
-                    display_partitions(d, **kwargs, wrapping=False, output_stream=f)
-                    print("\n\n", file=f)
+            with open(args.out, "a" if args.append else "w") as f:
+                format_block = partial(format_partitions, **kwargs, wrapping=False, error_stream=f)
+                write = f.write
+                for d in _split_blocks(data):
+                    output = format_block(d)
+                    if output is not None:
+                        write(output + "\n")
+                    write("\n\n\n")
         else:
-            for i, d in enumerate(re.split(r"[\n]{2,}", data)):
+            width = None if args.no_wrap else get_terminal_size((60, 20))[0]
+            display = partial(display_partitions, **kwargs, width=width)
+            for i, d in enumerate(_split_blocks(data)):
                 if i > 0: print("\n\n")
-                display_partitions(d, **kwargs, wrapping=(not args.no_wrap))
+                display(d)
     elif args.input:
         data = args.input
         display_partitions(data, **kwargs, wrapping=(not args.no_wrap))
     else:
         print("Enter input string (Press enter with no input to exit; for other input methods see --help):")
+        if stdin.isatty():
+            # Keep input() on terminals; loading readline gives it line editing and history
+            try:
+                import readline
+            except ImportError:
+                pass
+            def read_line():
+                try:
+                    return input("\n> ")
+                except EOFError:
+                    return ""
+        else:
+            write = stdout.write
+            readline = stdin.readline
+            def read_line():
+                write("\n> ")
+                stdout.flush()
+                return readline().rstrip("\n")
+        # The terminal may be resized between inputs, so keep sampling its width
+        display = partial(display_partitions, **kwargs, wrapping=(not args.no_wrap))
         try:
-            data = input("\n> ")
+            data = read_line()
             while data:
-                display_partitions(data, **kwargs, wrapping=(not args.no_wrap))
-                data = input("\n> ")
+                display(data)
+                data = read_line()
         except KeyboardInterrupt:
             print()
 